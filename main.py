@@ -1,10 +1,13 @@
 #!/usr/bin/env python3
 import os.path
-import re
 import sys
 import csv
+import shutil
+import urllib.error
 import urllib.request
-from datetime import datetime
+from collections import defaultdict
+from datetime import date, datetime, timedelta
+from operator import itemgetter
 
 # Base url for the mazamas csv calendar
 CAL_URL = "https://mazamas.org/calendar/csv/"
@@ -13,7 +16,8 @@ IGNORE_FIELDS = {"Activity Notes", "Assistant"}
 
 # Activity Types: {'Hike Route', 'Other', 'Field Session', 'Climb Route', 'Lecture',
 #                  'Snowshoe', 'Partner Event', 'Meeting', 'Course'}
-IGNORE_ACTIVITY_TYPES = {'Field Session', 'Lecture', 'Meeting', 'Hike Route', 'Ski Mountaineering Route'}
+IGNORE_ACTIVITY_TYPES = {sys.intern(s) for s in
+                         ('Field Session', 'Lecture', 'Meeting', 'Hike Route', 'Ski Mountaineering Route')}
 
 ACTIVITY_TYPE_ORDER = ["Course", "Hike Route", "Snowshoe", "Climb Route"]
 
@@ -22,6 +26,11 @@ DATE_FORMAT = "%Y-%m-%d"
 
 NOT_INTERESTED_FILE = "not_interested.txt"
 
+# Where we remember the url and Last-Modified header for the cached out.csv
+LAST_MODIFIED_FILE = "out.csv.lastmod"
+# Where the csv is downloaded to before it replaces out.csv
+CSV_TEMP_FILE = "out.csv.tmp"
+
 # Columns to reference directly
 ACTIVITY_TYPE = 'Activity Type'
 ACTIVITY_NAME = 'Activity Name'
@@ -35,14 +44,15 @@ TEAM_SIZE = 'Team Size'
 NUMBER_OF_OPENINGS = 'Number of openings'
 
 # We can't just use _now_ as now > today (since the hours come into play) so this basically rounds
-#  the date down to just the day
-TODAY = datetime.strptime(datetime.strftime(datetime.now(), DATE_FORMAT), DATE_FORMAT)
+#  the date down to just the day.  YYYY-MM-DD sorts the same as a string as it does as a date, so we
+#  keep it as a string and compare directly.
+TODAY_STR = datetime.now().strftime(DATE_FORMAT)
 
 
-def get_csv_url(current_datetime):
+def build_csv_url(current_datetime):
     """
-    Get the calendar csv directly from their website by building a URL
-    :return: List of csv entries (not parsed)
+    Build the URL for the calendar csv starting at the given date
+    :return: The URL as a string
     """
 
     # noinspection PyListCreation
@@ -53,24 +63,105 @@ def get_csv_url(current_datetime):
     options.append("days=90")
     options.append("start_date=" + current_datetime.strftime(DATE_FORMAT))
 
-    url = CAL_URL + "?" + "&".join(options)
+    return CAL_URL + "?" + "&".join(options)
+
+
+def download_csv(request):
+    """
+    Stream the response for the request into out.csv so we never hold the whole payload in memory,
+    and remember the Last-Modified header (if any) for the next conditional fetch.  The data goes to a
+    temp file first and only replaces out.csv once it has all arrived, so a cut off download can never
+    leave a partial out.csv that looks like a valid cache.
+    :param request: The urllib request to run
+    """
+    with urllib.request.urlopen(request) as response:
+        # We are about to replace out.csv, so whatever we remembered about it no longer applies
+        if os.path.exists(LAST_MODIFIED_FILE):
+            os.remove(LAST_MODIFIED_FILE)
+        try:
+            with open(CSV_TEMP_FILE, 'wb') as fh:
+                shutil.copyfileobj(response, fh)
+                size = fh.tell()
+            # urllib doesn't complain if the connection is closed early, so check the length ourselves
+            expected_size = response.headers.get('Content-Length')
+            if expected_size is not None and size != int(expected_size):
+                raise IOError(f'Incomplete download, got {size} of {expected_size} bytes')
+        except BaseException:
+            if os.path.exists(CSV_TEMP_FILE):
+                os.remove(CSV_TEMP_FILE)
+            raise
+        last_modified = response.headers.get('Last-Modified')
+
+    os.replace(CSV_TEMP_FILE, 'out.csv')
+    if last_modified is None:
+        return
+    with open(LAST_MODIFIED_FILE, 'w') as fh:
+        fh.write(request.full_url + "\n" + last_modified + "\n")
+
+
+def read_last_modified(url):
+    """
+    Get the Last-Modified header we saved the last time we fetched this exact url
+    :param url: The url we are about to fetch
+    :return: The Last-Modified value, or None if we have nothing cached for this url
+    """
+    if not os.path.exists('out.csv') or not os.path.exists(LAST_MODIFIED_FILE):
+        return None
+    with open(LAST_MODIFIED_FILE) as fh:
+        lines = fh.read().splitlines()
+    # The start date is part of the url, so anything cached from a previous day doesn't count
+    if len(lines) != 2 or lines[0] != url:
+        return None
+    return lines[1]
+
+
+def get_csv_url(current_datetime):
+    """
+    Get the calendar csv directly from their website by building a URL.
+    :return: Iterator over the csv entries (not parsed)
+    """
+    url = build_csv_url(current_datetime)
     print(f'Fetching url {url}')
-    response = urllib.request.urlopen(url)
-    lines = [line.decode('utf-8') for line in response.readlines()]
-    with open('out.csv', 'w') as fh:
-        fh.writelines(lines)
-    return lines
+    download_csv(urllib.request.Request(url))
+    with open('out.csv', encoding='utf-8', newline='') as fh:
+        yield from fh
 
 
-def get_csv_file():
+def get_csv_file(current_datetime):
     """
     Get the calendar csv from a local csv file. This is mostly for development as hitting their
     website directly would greatly slow down progress.
-    :return: List of csv entries (not parsed)
+    :return: Iterator over the csv entries (not parsed)
     """
     print("Reading out.csv")
-    with open("out.csv") as fh:
-        return fh.readlines()
+    with open("out.csv", encoding='utf-8', newline='') as fh:
+        yield from fh
+
+
+def get_csv_cached(current_datetime):
+    """
+    Get the calendar csv from their website, but only download it if it has changed since we last
+    fetched it.  Otherwise fall back to the copy we saved in out.csv.
+    :return: Iterator over the csv entries (not parsed)
+    """
+    url = build_csv_url(current_datetime)
+    headers = {}
+    last_modified = read_last_modified(url)
+    if last_modified is not None:
+        headers['If-Modified-Since'] = last_modified
+
+    print(f'Fetching url {url}')
+    try:
+        download_csv(urllib.request.Request(url, headers=headers))
+    except urllib.error.HTTPError as e:
+        if e.code != 304:
+            raise
+        print("Calendar not modified since last fetch")
+        yield from get_csv_file(current_datetime)
+        return
+
+    with open('out.csv', encoding='utf-8', newline='') as fh:
+        yield from fh
 
 
 def is_past(date_str):
@@ -79,26 +170,30 @@ def is_past(date_str):
     :param date_str: The date we are checking as a string
     :return: True if NOW is greater than the given date
     """
-    if date_str is None or date_str == '':
-        return False
-
-    return TODAY > datetime.strptime(date_str, DATE_FORMAT)
+    return bool(date_str) and TODAY_STR > date_str
 
 
-def is_full(event):
-    number_of_openings_str = event[NUMBER_OF_OPENINGS]
+def is_full(number_of_openings_str):
+    """
+    Check if an event has no openings left
+    :param number_of_openings_str: The number of openings as a string
+    :return: True if there are no openings (or we don't know how many there are)
+    """
     if number_of_openings_str is None or number_of_openings_str == '':
         return True
     number_of_openings = float(number_of_openings_str)
     return number_of_openings <= 0
 
 
-def read_csv(fetcher):
+def read_csv(fetcher, not_interested, bad_dates):
     """
-    Fetch the csv data and parse it into a list of events, with each event being represented
-    by a simple dictionary.
-    :param fetcher: Function to run to fetch the csv data
-    :return: List of events, with each event being represented by a simple dictionary
+    Fetch the csv data and parse it into events grouped by activity type, with each event being
+    represented by a simple dictionary.  Filtering happens as the rows are read so we only make one
+    pass over the data.
+    :param fetcher: Function to run to fetch the csv data, returning any iterable of csv lines
+    :param not_interested: Map of activity type to the set of "date : leader" keys we want to skip
+    :param bad_dates: Set of dates we are busy
+    :return: Map of activity type to the list of events of that type
     """
     # Run the fetcher and get the data to process
     data = fetcher(datetime.now())
@@ -109,67 +204,75 @@ def read_csv(fetcher):
     # this I'm going to alert if we see a possible double schedule.
     event_map = {}
 
-    headers = None
-    events = []
+    events_by_type = defaultdict(list)
     reader = csv.reader(data)
+    headers = next(reader, None)
+    if headers is None:
+        return events_by_type
+
+    # Work out which columns we keep once, rather than checking every cell of every row
+    keep_idx = [i for i, header in enumerate(headers) if header not in IGNORE_FIELDS]
+    kept_names = [headers[i] for i in keep_idx]
+    # Pull the kept columns out of a row in one C level call rather than a generator per row
+    kept_values = itemgetter(*keep_idx)
+
+    # Columns we need to look at before deciding whether the row is worth turning into an event
+    idx_type = headers.index(ACTIVITY_TYPE)
+    idx_name = headers.index(ACTIVITY_NAME)
+    idx_start = headers.index(START_DATE)
+    idx_leader = headers.index(LEADER)
+    idx_close = headers.index(REG_CLOSE_DATE)
+    idx_openings = headers.index(NUMBER_OF_OPENINGS)
+
     for row in reader:
-        if headers is None:
-            headers = row
+        # Activity types are used as set and dict keys all over, so intern them to keep those lookups cheap
+        activity_type = sys.intern(row[idx_type])
+        # Skip any activities we don't care about
+        if activity_type in IGNORE_ACTIVITY_TYPES:
+            continue
+        key = activity_type + ":" + row[idx_start] + ":" + row[idx_leader]
+        if key in event_map:
+            print("ALERT - Duplicate activity/event/leader %s" % key)
+            print("\t%s" % event_map[key])
+            print("\t%s" % row[idx_name])
         else:
-            event = {}
-            for i in range(0, len(row)):
-                if headers[i] in IGNORE_FIELDS:
-                    continue
-                event[headers[i]] = row[i]
-            # Skip any activities we don't care about
-            if event[ACTIVITY_TYPE] in IGNORE_ACTIVITY_TYPES:
-                continue
-            key = event[ACTIVITY_TYPE] + ":" + event[START_DATE] + ":" + event[LEADER]
-            if key in event_map:
-                print("ALERT - Duplicate activity/event/leader %s" % key)
-                print("\t%s" % event_map[key])
-                print("\t%s" % event[ACTIVITY_NAME])
-            else:
-                event_map[key] = event[ACTIVITY_NAME]
-            # Don't show events which are already closed
-            if is_past(event[REG_CLOSE_DATE]):
-                continue
-            # Don't show events which are not yet open
-            # if event[REG_OPEN_DATE] is None or event[REG_OPEN_DATE] == '':
-            #     continue
-            # Don't bother showing events which are already filled up
-            if is_full(event):
-                continue
-            # Don't show BCEP events
-            if event[ACTIVITY_NAME].startswith('BCEP'):
-                continue
-            events.append(event)
-    return events
+            event_map[key] = row[idx_name]
+        # Don't show BCEP events
+        if row[idx_name].startswith('BCEP'):
+            continue
+        # Don't bother showing events which are already filled up
+        if is_full(row[idx_openings]):
+            continue
+        # Don't show events which are already closed
+        if is_past(row[idx_close]):
+            continue
+        # Don't show events which are not yet open
+        # if event[REG_OPEN_DATE] is None or event[REG_OPEN_DATE] == '':
+        #     continue
+        # Don't show events on dates we are busy
+        start_date = row[idx_start]
+        if start_date in bad_dates:
+            continue
+        # Don't show events we have specifically said we aren't interested in
+        bad_keys = not_interested.get(activity_type)
+        if bad_keys is not None and start_date + " : " + row[idx_leader] in bad_keys:
+            continue
+        event = dict(zip(kept_names, kept_values(row)))
+        event[ACTIVITY_TYPE] = activity_type
+        event[LEADER] = sys.intern(event[LEADER])
+        events_by_type[activity_type].append(event)
+    return events_by_type
 
 
-def print_all_activity_types(events):
+def print_all_activity_types(events_by_type):
     """
-    Given the list of events, return a unique set of activities.  This was mostly a debugging tool.
-    :param events: The list of events to get the activity types from
-    :return: Set of all activity types
+    Given the grouped events, print the unique set of activities.  This was mostly a debugging tool.
+    :param events_by_type: Map of activity type to events, as returned by read_csv
     """
-    # find all activity types
-    activity_types = set()
-    for event in events:
-        activity_type = event[ACTIVITY_TYPE]
-        activity_types.add(activity_type)
-    print(f'Activity Types: {activity_types}')
+    print(f'Activity Types: {set(events_by_type)}')
 
 
-def print_events_by_type(events, by_open=False):
-
-    # Group by type
-    activity_types = {}
-    for event in events:
-        if event[ACTIVITY_TYPE] in activity_types:
-            activity_types[event[ACTIVITY_TYPE]].append(event)
-        else:
-            activity_types[event[ACTIVITY_TYPE]] = [event]
+def print_events_by_type(activity_types, by_open=False):
 
     # Print in the order of the ACTIVITY_TYPE_ORDER
     seen = {}
@@ -193,7 +296,7 @@ def print_events_by_type(events, by_open=False):
 def print_events(events, by_open=False):
 
     if by_open:
-        events.sort(key=lambda x: f"{x[REG_OPEN_DATE]} {x[START_DATE]}")
+        events.sort(key=lambda x: (x[REG_OPEN_DATE], x[START_DATE]))
         # print(events)
     for event in events:
         open_reg = "       "
@@ -208,6 +311,35 @@ def print_events(events, by_open=False):
         print(f'\t{event[START_DATE]} {open_reg} - {event[ACTIVITY_NAME]} - {pace}/{event[GRADE]} - {event[LEADER]}')
 
 
+def is_single_date(line):
+    """
+    Check if the given string is a single YYYY-MM-DD date.  The format is fixed width so we can just
+    look at the characters directly rather than going through a regex.
+    :param line: The string we are checking
+    :return: True if the string is a date
+    """
+    return (len(line) == 10 and line[4] == '-' and line[7] == '-'
+            and line[:4].isdigit() and line[5:7].isdigit() and line[8:].isdigit())
+
+
+def split_date_range(line):
+    """
+    Split a date range of the form YYYY-MM-DD - YYYY-MM-DD (spaces around the dash are optional)
+    :param line: The string we are checking
+    :return: Tuple of (start date, end date) or None if this isn't a date range
+    """
+    start_date = line[:10]
+    if not is_single_date(start_date):
+        return None
+    rest = line[10:].lstrip()
+    if not rest.startswith('-'):
+        return None
+    end_date = rest[1:].lstrip()
+    if not is_single_date(end_date):
+        return None
+    return start_date, end_date
+
+
 def read_not_interested():
 
     # Specific events we are not interested in
@@ -219,9 +351,6 @@ def read_not_interested():
     if not os.path.exists(NOT_INTERESTED_FILE):
         return events, dates
 
-    single_date = re.compile(r'^\d{4}-\d{2}-\d{2}$')
-    date_range = re.compile(r'^(\d{4}-\d{2}-\d{2})\s*-\s*(\d{4}-\d{2}-\d{2})$')
-
     # Read the entire file into a list
     with open(NOT_INTERESTED_FILE) as fh:
         data = fh.readlines()
@@ -244,66 +373,42 @@ def read_not_interested():
             if activity_type is None:
                 print("Can't have an event without a type: %s", line)
                 continue
-            events[activity_type].append(line)
+            events[activity_type].add(line)
             continue
 
         # This is either an activity heading, or a specific date
-        if single_date.match(line) is not None:
+        if is_single_date(line):
             dates.add(line)
             continue
 
-        match = date_range.match(line)
-        if match is not None:
-            start_date = match.group(1)
-            end_date = match.group(2)
-            add_dates(start_date, end_date, dates)
+        date_range = split_date_range(line)
+        if date_range is not None:
+            start_date, end_date = date_range
+            try:
+                add_dates(start_date, end_date, dates)
+            except ValueError:
+                print("Invalid date in range: %s" % line)
+                continue
 
         activity_type = line
         if activity_type not in events:
-            events[activity_type] = []
+            events[activity_type] = set()
 
     return events, dates
 
 
 def add_dates(start_date, end_date, dates):
-    y1, m1, d1 = [int(a) for a in start_date.split('-')]
-    y2, m2, d2 = [int(a) for a in end_date.split('-')]
-
-    # Hacky way to find dates between x and y
-    # Yes, not all months have 31 days, but for this it doesn't matter
-    while True:
-        date = f"{y1}-{m1:02}-{d1:02}"
-        dates.add(date)
-        d1 += 1
-        if d1 > 31:
-            d1 = 1
-            m1 += 1
-        if m1 > 12:
-            m1 = 1
-            y1 += 1
-        if y1 == y2 and m1 == m2 and d1 > d2:
-            break
-
-
-def filter_events(events, not_interested, bad_dates):
-    filtered = []
-    for event in events:
-        activity_type = event[ACTIVITY_TYPE]
-        start_date = event[START_DATE]
-        leader = event[LEADER]
-        if start_date in bad_dates:
-            # print("Bad date %s %s %s" % (activity_type, start_date, leader))
-            continue
-
-        # Create the key
-        key = start_date + " : " + leader
-        if activity_type in not_interested and key in not_interested[activity_type]:
-            # print("Skipping %s %s %s" % (activity_type, start_date, leader))
-            continue
-
-        filtered.append(event)
-
-    return filtered
+    """
+    Add every date between start_date and end_date (inclusive) to the set of dates
+    :param start_date: First date of the range as a string
+    :param end_date: Last date of the range as a string
+    :param dates: Set of date strings to add to
+    """
+    day = date.fromisoformat(start_date)
+    last_day = date.fromisoformat(end_date)
+    while day <= last_day:
+        dates.add(day.isoformat())
+        day += timedelta(days=1)
 
 
 def main(args):
@@ -312,17 +417,15 @@ def main(args):
     not_interested, bad_dates = read_not_interested()
 
     by_open = len(args) == 2 and args[1] == "-reg"
-    events = read_csv(get_csv_url)
-    # events = read_csv(get_csv_file)
+    events_by_type = read_csv(get_csv_cached, not_interested, bad_dates)
+    # events_by_type = read_csv(get_csv_url, not_interested, bad_dates)
+    # events_by_type = read_csv(get_csv_file, not_interested, bad_dates)
 
-    # Filter events for not interested
     if len(not_interested) > 0:
-        events = filter_events(events, not_interested, bad_dates)
         print()
 
-    print_events_by_type(events, by_open)
-    # for event in events:
-    #     print(event)
+    print_events_by_type(events_by_type, by_open)
+    # print_all_activity_types(events_by_type)
 
 
 # Press the green button in the gutter to run the script.